@@ -1,34 +1,313 @@
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import hashlib
-import json
+import mmap
+import os
+import re
 from pathlib import Path
 import sys
+import struct
 import time
-from typing import Dict, List, Tuple
+from typing import Callable, Dict, Iterator, List, Tuple, Union
 import zlib
 
 from sklearn import tree
 
+try:
+    # libdeflate bindings, noticeably faster than zlib for one-shot buffers
+    import deflate
+except ImportError:
+    deflate = None
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# read size used when streaming file contents into blobs
+CHUNK_SIZE = 1 << 20
+
+# blobs up to this size are compressed in one shot with libdeflate when it is
+# available, larger ones are streamed through zlib to bound memory use
+DEFLATE_MAX_SIZE = 4 << 20
+
+# upper bound on "<type> <size>\0", used to peek at a compressed object header
+MAX_HEADER_SIZE = 64
+
+# below this many files a process pool costs more than it saves
+PARALLEL_THRESHOLD = 16
+
+IGNORED_DIRS = {".pygit", ".git"}
+
+# loose objects favour speed over ratio, like git's core.loosecompression
+COMPRESSION_LEVEL = int(os.environ.get("PYGIT_COMPRESSION_LEVEL", "1"))
+
+# object ids are always 20 bytes; blake3 is much faster than sha1 but gives
+# ids that are not compatible with git. The algorithm is picked with
+# PYGIT_HASH at init and recorded in the repository, see set_hash_algorithm
+HASH_SIZE = 20
+HASH_ALGORITHM = "sha1"
+new_hash = hashlib.sha1
+
+
+def set_hash_algorithm(name: str):
+    global HASH_ALGORITHM, new_hash
+    if name == "sha1":
+        new_hash = hashlib.sha1
+    elif name == "blake3":
+        from blake3 import blake3
+        new_hash = partial(blake3, max_threads=blake3.AUTO)
+    else:
+        raise ValueError(f"Unsupported hash algorithm {name}")
+    HASH_ALGORITHM = name
+
+
+def hex_digest(h) -> str:
+    # blake3 produces 32 bytes by default, truncate to the object id size
+    return h.hexdigest()[:2 * HASH_SIZE]
+
+
+def compress(header: bytes, content: bytes, level: int = COMPRESSION_LEVEL) -> bytes:
+    if deflate is not None:
+        # libdeflate wants one contiguous input, so copy both parts into a
+        # single preallocated buffer instead of allocating header + content
+        buf = bytearray(len(header) + len(content))
+        mv = memoryview(buf)
+        mv[:len(header)] = header
+        mv[len(header):] = content
+        return deflate.zlib_compress(buf, level)
+
+    compressor = zlib.compressobj(level)
+    return b"".join((compressor.compress(header),
+                     compressor.compress(content),
+                     compressor.flush()))
+
+
+def decompress(data: bytes) -> Union[bytes, bytearray]:
+    # libdeflate returns a bytearray, zlib returns bytes
+    if deflate is None:
+        return zlib.decompress(data)
+
+    # libdeflate needs the output size up front, which the object header
+    # carries, so inflate just enough of the stream to read it
+    head = zlib.decompressobj().decompress(data, MAX_HEADER_SIZE)
+    null_idx = head.find(b"\0")
+    _, size = head[:null_idx].split(b" ")
+    return deflate.zlib_decompress(data, null_idx + 1 + int(size))
+
+
+def write_all(fd: int, data: bytes):
+    mv = memoryview(data)
+    while mv:
+        mv = mv[os.write(fd, mv):]
+
+
+def blob_size(f) -> int:
+    # taken from the open file, so it describes what is about to be read
+    return os.fstat(f.fileno()).st_size
+
+
+def check_blob_size(path, size: int, total: int):
+    # the header length was fixed before reading, a file that changed or
+    # lies about its size (procfs) would otherwise give a corrupt object
+    if total != size:
+        raise OSError(f"short read of {path}: expected {size} bytes, got {total}")
+
+
+def read_blob(path, f, size: int) -> Iterator[memoryview]:
+    # chunks share one buffer, each is only valid until the next is read
+    buf = bytearray(CHUNK_SIZE)
+    mv = memoryview(buf)
+    total = 0
+    while True:
+        n = f.readinto(buf)
+        if not n:
+            break
+        total += n
+        yield mv[:n]
+    check_blob_size(path, size, total)
+
+
+def read_blob_into(f, mv: memoryview) -> int:
+    # fills mv from f and returns the number of bytes the file held, which
+    # exceeds len(mv) if the file turned out to be longer
+    total = 0
+    while total < len(mv):
+        n = f.readinto(mv[total:])
+        if not n:
+            return total
+        total += n
+    while True:
+        extra = f.read(CHUNK_SIZE)
+        if not extra:
+            return total
+        total += len(extra)
+
+
+def stream_blob(path, write: Callable[[bytes], object]) -> str:
+    # hash and compress the file in a single pass, compressed chunks go to
+    # write() as they are produced; files above DEFLATE_MAX_SIZE are streamed
+    # through zlib so they are never fully loaded into memory
+    with open(path, "rb", buffering=0) as f:
+        size = blob_size(f)
+        header = f"blob {size}\0".encode()
+        h = new_hash()
+
+        if deflate is not None and size <= DEFLATE_MAX_SIZE:
+            # libdeflate only works on whole buffers, so read header and
+            # content into one and compress it in a single call
+            buf = bytearray(len(header) + size)
+            mv = memoryview(buf)
+            mv[:len(header)] = header
+            check_blob_size(path, size, read_blob_into(f, mv[len(header):]))
+            h.update(buf)
+            write(deflate.zlib_compress(buf, COMPRESSION_LEVEL))
+            return hex_digest(h)
+
+        h.update(header)
+        compressor = zlib.compressobj(COMPRESSION_LEVEL)
+        write(compressor.compress(header))
+
+        for data in read_blob(path, f, size):
+            h.update(data)
+            chunk = compressor.compress(data)
+            if chunk:
+                write(chunk)
+    write(compressor.flush())
+
+    return hex_digest(h)
+
+
+def open_tmp_object(objects_path: str) -> Tuple[int, str]:
+    # objects are written to a uniquely named temporary file and renamed into
+    # place, so readers never see a partially written object
+    tmp_file = os.path.join(objects_path, f"tmp_obj_{os.urandom(6).hex()}")
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+    return os.open(tmp_file, flags, 0o444), tmp_file
+
+
+def stream_blob_to_tmp(objects_path: str, path) -> Tuple[str, str]:
+    # the compressed blob goes straight to disk instead of into memory; the
+    # caller renames the returned temporary file once it knows the hash
+    fd, tmp_file = open_tmp_object(objects_path)
+    try:
+        obj_hash = stream_blob(path, lambda chunk: write_all(fd, chunk))
+    except BaseException:
+        os.close(fd)
+        os.unlink(tmp_file)
+        raise
+    os.close(fd)
+    return obj_hash, tmp_file
+
+
+def stream_blobs_to_tmp(objects_path: str, paths: List[str]) -> List[Tuple[str, str]]:
+    # process pool worker, handles a batch of files per task to save on IPC
+    results = []
+    try:
+        for path in paths:
+            results.append(stream_blob_to_tmp(objects_path, path))
+    except BaseException:
+        for _, tmp_file in results:
+            os.unlink(tmp_file)
+        raise
+    return results
+
+
+def hash_file(path) -> str:
+    # hash only, so files whose blob is already stored are never compressed
+    with open(path, "rb", buffering=0) as f:
+        size = blob_size(f)
+        h = new_hash()
+        h.update(f"blob {size}\0".encode())
+        if hasattr(hashlib, "file_digest"):
+            # python 3.11+: reads into an internal buffer and updates the
+            # digest in C without building bytes objects; it reads to EOF,
+            # so the file position is the number of bytes hashed
+            hashlib.file_digest(f, lambda: h)
+            check_blob_size(path, size, f.tell())
+        else:
+            for data in read_blob(path, f, size):
+                h.update(data)
+    return hex_digest(h)
+
+
+def walk_files(root: str) -> Iterator[str]:
+    # DirEntry caches the file type from readdir, so unlike Path.rglob this
+    # needs no extra stat call per entry
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.name in IGNORED_DIRS:
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file():
+                    # a symlink to a file stages the file's content; only
+                    # symlinks cost a stat here, plain entries use d_type
+                    yield entry.path
+                elif entry.is_symlink():
+                    print(f"Warning: skipping symlink {entry.path}", file=sys.stderr)
+
+
+# index layout: u32 entry count, then per entry u16 path length, the utf-8
+# path and the raw 20 byte object hash, all big-endian
+INDEX_COUNT = struct.Struct(">I")
+INDEX_PATH_LEN = struct.Struct(">H")
+
+
+def parse_index(data) -> Dict[str, bytes]:
+    count, = INDEX_COUNT.unpack_from(data, 0)
+    offset = INDEX_COUNT.size
+    index = {}
+    for _ in range(count):
+        path_len, = INDEX_PATH_LEN.unpack_from(data, offset)
+        offset += INDEX_PATH_LEN.size
+        path = data[offset:offset + path_len].decode()
+        offset += path_len
+        index[path] = data[offset:offset + HASH_SIZE]
+        offset += HASH_SIZE
+    return index
+
+
+def serialize_index(index: Dict[str, bytes]) -> bytes:
+    out = bytearray(INDEX_COUNT.pack(len(index)))
+    for path, obj_hash in index.items():
+        encoded = path.encode()
+        out += INDEX_PATH_LEN.pack(len(encoded))
+        out += encoded
+        out += obj_hash
+    return bytes(out)
+
 
 class GitObject:
     def __init__(self, obj_type: str, content: bytes):
         self.type = obj_type
         self.content = content
+        self._hash = None
 
     def hash(self) -> str:
-        header = f"{self.type} {len(self.content)}\0".encode()
-        return hashlib.sha1(header + self.content).hexdigest()
+        if self._hash is None:
+            header = f"{self.type} {len(self.content)}\0".encode()
+            h = new_hash()
+            h.update(header)
+            h.update(self.content)
+            self._hash = hex_digest(h)
+        return self._hash
 
     def serialize(self) -> bytes:
         header = f"{self.type} {len(self.content)}\0".encode()
-        return zlib.compress(header + self.content)
+        return compress(header, self.content)
 
     @classmethod
     def deserialize(cls, data: bytes) -> "GitObject":
-        decompressed = zlib.decompress(data)
+        decompressed = decompress(data)
         null_idx = decompressed.find(b"\0")
         header = decompressed[:null_idx].decode()
-        content = decompressed[null_idx+1:]
+        # always immutable bytes, whichever backend inflated it, so the
+        # memoized hash can't go stale through an in-place edit
+        content = bytes(memoryview(decompressed)[null_idx+1:])
 
         obj_type, _ = header.split(" ")
         return cls(obj_type, content)
@@ -42,40 +321,62 @@ class Blob(GitObject):
         return self.content
 
 
+def entry_sort_key(entry: Tuple[str, str, bytes]) -> str:
+    # git orders tree entries by name, comparing subtrees as if named "<name>/"
+    mode, name, _ = entry
+    return name + "/" if mode == "40000" else name
+
+
+# one tree entry: <mode> <name>\0<20 byte object hash>
+TREE_ENTRY = re.compile(rb"(\d+) ([^\0]*)\0(.{%d})" % HASH_SIZE, re.DOTALL)
+
+
+def parse_tree_entries(content: bytes) -> List[Tuple[str, str, bytes]]:
+    # the regex engine does the byte scanning in C, which is considerably
+    # faster than stepping through the content with find() and slicing
+    return [(mode.decode(), name.decode(), obj_hash)
+            for mode, name, obj_hash in TREE_ENTRY.findall(content)]
+
+
+def serialize_tree_entries(entries: List[Tuple[str, str, bytes]]) -> bytes:
+    content = bytearray()
+    for mode, name, obj_hash in entries:
+        content += f"{mode} {name}\0".encode()
+        content += obj_hash
+    return bytes(content)
+
+
 class Tree(GitObject):
-    def __init__(self, entries: List[Tuple[str, str, str]] = None):
+    def __init__(self, entries: List[Tuple[str, str, bytes]] = None):
         self.entries = entries or []
-        content = self._serialize_entries()
-        super().__init__("tree", content)
+        super().__init__("tree", b"")
+        self._dirty = True
+
+    @property
+    def content(self) -> bytes:
+        # serialized lazily, so a run of add_entry calls costs one rebuild
+        if self._dirty:
+            self._content = self._serialize_entries()
+            self._dirty = False
+        return self._content
+
+    @content.setter
+    def content(self, content: bytes):
+        self._content = content
+        self._dirty = False
 
     def _serialize_entries(self) -> bytes:
-        # format: <mode> <name>\0<obj_hash>
-        content = b""
-        for mode, name, obj_hash in sorted(self.entries):
-            content += f"{mode} {name}\0".encode()
-            content += bytes.fromhex(obj_hash)
-
-        return content
+        return serialize_tree_entries(sorted(self.entries, key=entry_sort_key))
 
-    def add_entry(self, mode: str, name: str, obj_hash: str):
+    def add_entry(self, mode: str, name: str, obj_hash: bytes):
         self.entries.append((mode, name, obj_hash))
-        self.content = self._serialize_entries()
+        self._dirty = True
+        self._hash = None
 
     @classmethod
     def from_content(cls, content: bytes) -> "Tree":
-        tree = cls()
-        i = 0
-        while i < len(content):
-            null_idx = content.find(b"\0", i)
-            if null_idx == -1:
-                break
-
-            mode_name = content[i:null_idx].decode()
-            mode, name = mode_name.split(" ", 1)
-            obj_hash = content[null_idx+1: null_idx+21].hex()
-
-            tree.entries.append((mode, name, obj_hash))
-            i = null_idx + 21
+        tree = cls(parse_tree_entries(content))
+        tree.content = content
         return tree
 
 
@@ -151,9 +452,36 @@ class Repository:
         # .git/index (Staging area)
         self.index_file = self.git_dir / "index"
 
+        # hash algorithm used for object ids
+        self.object_format_file = self.git_dir / "objectformat"
+
+        # plain string paths for the object store hot path
+        self._objects_path = str(self.objects_dir)
+        self._mkdir_cache = set()
+        self._known_hashes = None
+
+        # staging area is loaded once and written back by flush()
+        self._index = None
+        self._index_dirty = False
+
+        if self.git_dir.exists():
+            self._use_object_format()
+
+    def _use_object_format(self):
+        # repositories created before the format was recorded use sha1
+        recorded = "sha1"
+        if self.object_format_file.exists():
+            recorded = self.object_format_file.read_text().strip()
+        requested = os.environ.get("PYGIT_HASH")
+        if requested and requested != recorded:
+            raise ValueError(f"PYGIT_HASH={requested} does not match the repository's {recorded} object ids")
+        set_hash_algorithm(recorded)
+
     def init(self) -> bool:
         if self.git_dir.exists():
             return False
+        algorithm = os.environ.get("PYGIT_HASH", "sha1")
+        set_hash_algorithm(algorithm)
         self.git_dir.mkdir()
         self.objects_dir.mkdir()
         self.ref_dir.mkdir()
@@ -161,7 +489,9 @@ class Repository:
 
         # create initial HEAD pointing to a branch
         self.head_file.write_text("ref: refs/heads/main\n")
-        self.index_file.write_text(json.dumps({}, indent=2))
+        self.object_format_file.write_text(algorithm + "\n")
+        self.save_index({})
+        self.flush()
 
         print(f"Initialized Empty PyGit Repository in {self.git_dir}")
 
@@ -169,25 +499,118 @@ class Repository:
 
     def store_object(self, obj: GitObject) -> str:
         obj_hash = obj.hash()
-        obj_dir = self.objects_dir / obj_hash[:2]
-        obj_file = obj_dir / obj_hash[2:]
+        if not self._has_object(obj_hash):
+            self._write_object(obj_hash, obj.serialize())
+        return obj_hash
+
+    def _has_object(self, obj_hash: str) -> bool:
+        if self._known_hashes is None:
+            # list the object store once instead of stat-ing every object
+            self._known_hashes = set()
+            if os.path.isdir(self._objects_path):
+                with os.scandir(self._objects_path) as obj_dirs:
+                    for obj_dir in obj_dirs:
+                        if not obj_dir.is_dir() or len(obj_dir.name) != 2:
+                            continue
+                        self._mkdir_cache.add(obj_dir.name)
+                        with os.scandir(obj_dir.path) as obj_files:
+                            for obj_file in obj_files:
+                                self._known_hashes.add(obj_dir.name + obj_file.name)
+        return obj_hash in self._known_hashes
+
+    def _install_object(self, tmp_file: str, obj_hash: str):
+        prefix = obj_hash[:2]
+        obj_dir = os.path.join(self._objects_path, prefix)
+        if prefix not in self._mkdir_cache:
+            os.makedirs(obj_dir, exist_ok=True)
+            self._mkdir_cache.add(prefix)
+
+        os.replace(tmp_file, os.path.join(obj_dir, obj_hash[2:]))
+        if self._known_hashes is not None:
+            self._known_hashes.add(obj_hash)
+
+    def _keep_object(self, tmp_file: str, obj_hash: str):
+        if self._has_object(obj_hash):
+            os.unlink(tmp_file)
+        else:
+            self._install_object(tmp_file, obj_hash)
 
-        if not obj_file.exists():
-            obj_dir.mkdir(exist_ok=True)
-            obj_file.write_bytes(obj.serialize())
+    def _write_object(self, obj_hash: str, data: bytes):
+        fd, tmp_file = open_tmp_object(self._objects_path)
+        try:
+            write_all(fd, data)
+        except BaseException:
+            os.close(fd)
+            os.unlink(tmp_file)
+            raise
+        os.close(fd)
+        self._install_object(tmp_file, obj_hash)
+
+    def hash_and_store_file(self, path) -> str:
+        obj_hash = hash_file(path)
+        if self._has_object(obj_hash):
+            return obj_hash
+
+        # the streaming pass re-hashes, so the stored object always matches
+        # its id even if the file changed since hash_file read it
+        obj_hash, tmp_file = stream_blob_to_tmp(self._objects_path, path)
+        self._keep_object(tmp_file, obj_hash)
         return obj_hash
 
-    def load_index(self) -> Dict[str, str]:
+    def _store_in_pool(self, executor: ProcessPoolExecutor, paths: List[str]) -> Dict[str, str]:
+        batches = [paths[i:i + 16] for i in range(0, len(paths), 16)]
+        futures = [executor.submit(stream_blobs_to_tmp, self._objects_path, batch)
+                   for batch in batches]
+        hashes = {}
+        try:
+            for batch, future in zip(batches, futures):
+                for path, (obj_hash, tmp_file) in zip(batch, future.result()):
+                    self._keep_object(tmp_file, obj_hash)
+                    hashes[path] = obj_hash
+        except BaseException:
+            # don't leave the temporary files of finished batches behind
+            for future in futures:
+                if future.cancel() or future.exception() is not None:
+                    continue
+                for _, tmp_file in future.result():
+                    if os.path.exists(tmp_file):
+                        os.unlink(tmp_file)
+            raise
+        return hashes
+
+    def load_index(self) -> Dict[str, bytes]:
+        if self._index is None:
+            self._index = self._read_index()
+        return self._index
+
+    def _read_index(self) -> Dict[str, bytes]:
         if not self.index_file.exists():
             return {}
 
         try:
-            return json.loads(self.index_file.read_text())
-        except:
+            with open(self.index_file, "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return {}
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    # indexes written by older versions are JSON
+                    if mm[:1] == b"{":
+                        return {path: bytes.fromhex(obj_hash)
+                                for path, obj_hash in json_loads(mm[:]).items()}
+                    return parse_index(mm)
+        except (ValueError, struct.error):
             return {}
 
-    def save_index(self, index: Dict[str, str]):
-        self.index_file.write_text(json.dumps(index, indent=2))
+    def save_index(self, index: Dict[str, bytes]):
+        self._index = index
+        self._index_dirty = True
+
+    def flush(self):
+        if not self._index_dirty:
+            return
+        tmp_file = self.index_file.with_name("index.tmp")
+        tmp_file.write_bytes(serialize_index(self._index))
+        os.replace(tmp_file, self.index_file)
+        self._index_dirty = False
 
     def add_directory(self, path):
         full_path = self.path / path
@@ -197,19 +620,39 @@ class Repository:
         if not full_path.is_dir():
             raise ValueError(f"{path} is not a directory")
 
+        # from here on paths are plain strings, index keys are sliced off
+        # the repository prefix instead of going through Path.relative_to
+        root = os.path.normpath(str(full_path))
+        base = os.path.join(str(self.path), "")
+        if not os.path.join(root, "").startswith(base):
+            raise ValueError(f"{path} is outside the repository")
+        self._check_not_ignored(root, path)
+        file_paths = list(walk_files(root))
+
+        if len(file_paths) < PARALLEL_THRESHOLD:
+            # streams each new blob straight to disk
+            hashes = {p: self.hash_and_store_file(p) for p in file_paths}
+        else:
+            # hashing and compressing are CPU bound and independent per file,
+            # so fan them out to worker processes; workers stream new blobs
+            # into their own temporary files and only the renames into the
+            # object store happen here
+            # workers need the repository's hash algorithm, which isn't
+            # inherited when they are spawned rather than forked
+            with ProcessPoolExecutor(initializer=set_hash_algorithm,
+                                     initargs=(HASH_ALGORITHM,)) as executor:
+                hashes = dict(zip(file_paths, executor.map(hash_file, file_paths, chunksize=16)))
+                new_paths = [p for p, h in hashes.items() if not self._has_object(h)]
+                hashes.update(self._store_in_pool(executor, new_paths))
+
         index = self.load_index()
-        for file_path in full_path.rglob("*"):
-            if file_path.is_file():
-                if ".pygit" or ".git" in file_path.parts:
-                    continue
-                print(file_path)
-                content = file_path.read_bytes()
-                blob = Blob(content)
-                blob_hash = self.store_object(blob)
-                relative_path = str(file_path.relative_to(self.path))
-                index[relative_path] = blob_hash
-                print(relative_path)
-                added_count += 1
+        for file_path, blob_hash in hashes.items():
+            relative_path = file_path[len(base):]
+            if os.sep != "/":
+                relative_path = relative_path.replace(os.sep, "/")
+            index[relative_path] = bytes.fromhex(blob_hash)
+            print(relative_path)
+            added_count += 1
 
         self.save_index(index)
         if added_count > 0:
@@ -221,16 +664,23 @@ class Repository:
         full_path = self.path / path
         if not full_path.exists():
             raise FileNotFoundError(f"Path {path} not found")
+        self._check_not_ignored(os.path.normpath(str(full_path)), path)
 
-        content = full_path.read_bytes()
-        blob = Blob(content)
-        blob_hash = self.store_object(blob)
+        blob_hash = self.hash_and_store_file(full_path)
         index = self.load_index()
-        index[path] = blob_hash
+        index[path] = bytes.fromhex(blob_hash)
         self.save_index(index)
 
         print(f"Added {path}")
 
+    def _check_not_ignored(self, full_path: str, path):
+        # walk_files only prunes ignored directories below its root, so
+        # refuse paths that point into one, like git add .git does
+        parts = os.path.relpath(full_path, str(self.path)).split(os.sep)
+        for part in parts:
+            if part in IGNORED_DIRS:
+                raise ValueError(f"Refusing to add {path}: {part} is never tracked")
+
     def add_path(self, path: str) -> None:
         full_path = self.path / path
 
@@ -245,54 +695,46 @@ class Repository:
             raise ValueError(f"{path} is neither a file nor a directory")
 
     def load_object(self, obj_hash: str) -> "GitObject":
-        obj_dir = self.objects_dir / obj_hash[:2]
-        obj_file = obj_dir / obj_hash[2:]
-        if not obj_file.exists():
-            raise FileNotFoundError(f"Object {obj_hash} not found")
+        obj_file = os.path.join(self._objects_path, obj_hash[:2], obj_hash[2:])
+        try:
+            f = open(obj_file, "rb")
+        except FileNotFoundError:
+            raise FileNotFoundError(f"Object {obj_hash} not found") from None
 
-        return GitObject.deserialize(obj_file.read_bytes())
+        # hand the mapped file straight to the decompressor instead of
+        # copying it into a bytes object first
+        with f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return GitObject.deserialize(mm)
 
     def create_tree_from_index(self):
         index = self.load_index()
-        if not index:
-            tree = Tree()
-            return self.store_object(tree)
-
-        dirs = {}
-        files = {}
-
-        for file_path, blob_hash in index.items():
-            parts = file_path.split("/")
-
-            if len(parts) == 1:
-                files[parts[0]] = blob_hash
-            else:
-                dir_name = parts[0]
-                if dir_name not in dirs:
-                    dirs[dir_name] = {}
-                current = dirs[dir_name]
-                for part in parts[1:-1]:
-                    if part not in current:
-                        current[part] = {}
-
-                    current = current[part]
-                current[parts[-1]] = blob_hash
-
-        def create_tree_recursive(entries_dict: Dict):
-            tree = Tree()
-            for name, blob_hash in entries_dict.items():
-                if isinstance(blob_hash, str):
-                    tree.add_entry("100644", name, blob_hash)
-                if isinstance(blob_hash, dict):
-                    subtree_hash = create_tree_recursive(blob_hash)
-                    tree.add_entry("40000", name, subtree_hash)
-                return self.store_object(tree)
-
-        root_entries = {**files}
-        for dir_name, dir_contents in dirs.items():
-            root_entries[dir_name] = dir_contents
-
-        return create_tree_recursive(root_entries)
+
+        # walk the paths in sorted order, keeping a stack of the trees for
+        # the directories of the current path; a directory is complete, and
+        # gets stored, as soon as a path outside of it comes up
+        stack = [("", Tree())]
+        for file_path, blob_hash in sorted(index.items()):
+            *dirs, name = file_path.split("/")
+
+            depth = 0
+            while (depth < len(dirs) and depth + 1 < len(stack)
+                   and stack[depth + 1][0] == dirs[depth]):
+                depth += 1
+            while len(stack) - 1 > depth:
+                self._close_tree(stack)
+
+            for dir_name in dirs[depth:]:
+                stack.append((dir_name, Tree()))
+            stack[-1][1].add_entry("100644", name, blob_hash)
+
+        while len(stack) > 1:
+            self._close_tree(stack)
+        return self.store_object(stack[0][1])
+
+    def _close_tree(self, stack: List[Tuple[str, Tree]]):
+        dir_name, tree = stack.pop()
+        tree_hash = self.store_object(tree)
+        stack[-1][1].add_entry("40000", dir_name, bytes.fromhex(tree_hash))
 
     def get_current_branch(self) -> str:
         if not self.head_file.exists():
@@ -345,6 +787,7 @@ class Repository:
 
         self.set_branch_commit(current_branch, commit_hash)
         self.save_index({})
+        self.flush()
         print(f"Created commit {commit_hash} on branch {current_branch}")
         return commit_hash
 
@@ -376,9 +819,8 @@ def main():
         parser.print_help()
         return
 
-    repo = Repository()
-
     try:
+        repo = Repository()
         if args.command == "init":
             if not repo.init():
                 print("Repository already exists")
@@ -391,6 +833,7 @@ def main():
             # print(args.paths)
             for path in args.paths:
                 repo.add_path(path)
+            repo.flush()
         elif args.command == "commit":
             if not repo.git_dir.exists():
                 print("Not a PyGit Repository")
@@ -402,4 +845,5 @@ def main():
         sys.exit(1)
 
 
-main()
+if __name__ == "__main__":
+    main()